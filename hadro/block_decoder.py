@@ -0,0 +1,244 @@
+# ---------------------------------------------------------------------------------
+# Block decoding for schemas made up only of fixed-width fields.
+#
+# When none of the fields are nullable every record is the same size, so a block of
+# records is a strided array: numpy reads it in place with a structured dtype that
+# matches the record layout (see hadro.record), and each column is materialized with
+# one byteswapping copy into a native array.
+#
+# When there are nullable fields the records vary in size, and we walk them in a
+# compiled loop: we generate the source of a decoder for the schema, with the
+# position and width of each field written out, and compile it with Numba. The
+# decoder walks the block a batch of records at a time, skipping deleted ones, and
+# writes the values into one numpy array per column.
+#
+# Numba is optional, without it for schemas with nullable fields, or for schemas with
+# VARCHAR or types the struct codec doesn't support, there is no block decoder and
+# rows are decoded by the Python row codec.
+
+import sys
+import typing
+
+import numpy
+from hadro.record import DELETED_FLAG
+from hadro.record import FIXED_WIDTH_TYPES
+from hadro.record import RECORD_HEADER
+from hadro.record import SCHEMA_MISMATCH
+
+try:
+    import numba
+except ImportError:  # pragma: no cover
+    numba = None
+
+NUMPY_TYPES: typing.Dict[str, typing.Any] = {
+    "BOOLEAN": numpy.bool_,
+    "INTEGER": numpy.int64,
+    "FLOAT": numpy.float64,
+}
+_WIDTHS: typing.Dict[str, int] = {"BOOLEAN": 1, "INTEGER": 8, "FLOAT": 8}
+_DISK_TYPES: typing.Dict[str, str] = {"BOOLEAN": "?", "INTEGER": ">i8", "FLOAT": ">f8"}
+# RECORD_HEADER as numpy fields
+_HEADER_FIELDS: typing.List[typing.Tuple[str, str]] = [("flags", "u1"), ("size", ">u4")]
+
+_DECODERS: typing.Dict[tuple, "BlockDecoder"] = {}
+
+
+class BlockDecoder:
+    """
+    Decodes blocks of records into numpy columns, with a structured numpy view when
+    the records are all the same size and with a compiled loop when they are not.
+
+    Attributes:
+        types (list[str]): the schema type of each column
+        nullable (list[bool]): if each column is nullable
+    """
+
+    def __init__(self, schema: dict):
+        self.types = [info["type"] for info in schema.values()]
+        self.nullable = [info.get("nullable", True) for info in schema.values()]
+        fixed_size = sum(_WIDTHS[t] for t, n in zip(self.types, self.nullable) if not n)
+        self._minimum_record_size = RECORD_HEADER.size + fixed_size + (sum(self.nullable) + 7) // 8
+        self._record_dtype = None
+        self._decode = None
+        if any(self.nullable):
+            self._decode = numba.njit(nogil=True)(
+                _generate(self.types, self.nullable, self._minimum_record_size - RECORD_HEADER.size)
+            )
+        else:
+            self._record_dtype = numpy.dtype(
+                _HEADER_FIELDS + [(f"v{i}", _DISK_TYPES[t]) for i, t in enumerate(self.types)]
+            )
+
+    def decode_batches(self, block, batch_size: int) -> typing.Iterator[typing.Tuple[list, list]]:
+        """
+        Decode the live records in the block, batch_size records at a time, each
+        batch is decoded as it is asked for. Batches of only deleted records are
+        skipped.
+
+        Args:
+            block: a bytes-like object holding complete records
+            batch_size: the most records to decode in each batch
+
+        Yields:
+            a list of the values of each column and a list of the presence of the
+            values of each column (None for columns which aren't nullable)
+        """
+        if self._record_dtype is not None:
+            yield from self._decode_fixed_size(block, batch_size)
+            return
+
+        buffer = numpy.frombuffer(block, dtype=numpy.uint8)
+        capacity = min(batch_size, len(buffer) // self._minimum_record_size + 1)
+        offset = 0
+        while offset < len(buffer):
+            values = [numpy.empty(capacity, dtype=NUMPY_TYPES[t]) for t in self.types]
+            present = [numpy.empty(capacity if n else 0, dtype=numpy.bool_) for n in self.nullable]
+
+            count, offset = self._decode(buffer, offset, *values, *present)
+            if count < 0:
+                raise ValueError(SCHEMA_MISMATCH)
+
+            if count:
+                yield (
+                    [column[:count] for column in values],
+                    [
+                        column[:count] if nullable else None
+                        for column, nullable in zip(present, self.nullable)
+                    ],
+                )
+
+    def _decode_fixed_size(
+        self, block, batch_size: int
+    ) -> typing.Iterator[typing.Tuple[list, list]]:
+        count, torn = divmod(len(block), self._record_dtype.itemsize)
+        if torn:
+            raise ValueError(SCHEMA_MISMATCH)
+        # a view over the block, nothing is read until a batch is sliced from it
+        records = numpy.frombuffer(block, dtype=self._record_dtype, count=count)
+
+        for start in range(0, count, batch_size):
+            batch = records[start : start + batch_size]
+            if not numpy.all(batch["size"] == self._minimum_record_size - RECORD_HEADER.size):
+                raise ValueError(SCHEMA_MISMATCH)
+
+            live = (batch["flags"] & DELETED_FLAG) == 0
+            if not live.any():
+                continue
+            if live.all():
+                live = None
+            values = []
+            for i, field_type in enumerate(self.types):
+                # a strided view over the block, the only copy is converting it to native
+                column = batch[f"v{i}"]
+                if live is not None:
+                    column = column[live]
+                values.append(column.astype(NUMPY_TYPES[field_type]))
+            yield values, [None] * len(self.types)
+
+
+def _generate(
+    types: typing.List[str], nullable: typing.List[bool], minimum_size: int
+) -> typing.Callable:
+    """
+    Generate the decoding loop for the schema, the fields are read in the order they
+    are written: the non-nullable fields, the null bitmap and then the nullable fields.
+
+    The loop starts at offset and stops when the columns are full, it returns the
+    number of records decoded and the offset to carry on from. The count is -1 if a
+    record doesn't fit the schema or runs past the end of the block, so a damaged
+    file or the wrong schema can't read outside the buffer or the columns.
+    """
+    columns = range(len(types))
+    arguments = ", ".join([f"v{i}" for i in columns] + [f"p{i}" for i in columns])
+    # numbers are written big-endian, on little-endian hosts the bytes are reversed
+    # as they are copied out of the block
+    reverse = sys.byteorder == "little"
+
+    def read(index: int, indent: str, checked: bool = False) -> typing.List[str]:
+        width = _WIDTHS[types[index]]
+        lines = []
+        if checked:
+            # only the non-nullable values and the bitmap are covered by the minimum size
+            lines = [f"{indent}if at + {width} > record_end:", f"{indent}    return -1, offset"]
+        if types[index] == "BOOLEAN":
+            return lines + [f"{indent}v{index}[n] = buffer[at] != 0", f"{indent}at += 1"]
+        dtype = NUMPY_TYPES[types[index]].__name__
+        source = f"buffer[at + {width - 1} - k]" if reverse else "buffer[at + k]"
+        return lines + [
+            f"{indent}for k in range({width}):",
+            f"{indent}    scratch[k] = {source}",
+            f"{indent}v{index}[n] = scratch.view(numpy.{dtype})[0]",
+            f"{indent}at += {width}",
+        ]
+
+    # the header is the flags byte followed by the four byte size, see RECORD_HEADER
+    header = RECORD_HEADER.size
+    lines = [
+        f"def decode(buffer, offset, {arguments}):",
+        "    scratch = numpy.empty(8, dtype=numpy.uint8)",
+        "    capacity = v0.shape[0]",
+        "    end = buffer.shape[0]",
+        "    n = 0",
+        f"    while n < capacity and offset + {header} <= end:",
+        "        size = (",
+        "            (numpy.int64(buffer[offset + 1]) << 24)",
+        "            | (numpy.int64(buffer[offset + 2]) << 16)",
+        "            | (numpy.int64(buffer[offset + 3]) << 8)",
+        "            | numpy.int64(buffer[offset + 4])",
+        "        )",
+        f"        record_end = offset + {header} + size",
+        f"        if size < {minimum_size} or record_end > end:",
+        "            return -1, offset",
+        f"        if buffer[offset] & {DELETED_FLAG} == 0:",
+        f"            at = offset + {header}",
+    ]
+    for index in columns:
+        if not nullable[index]:
+            lines.extend(read(index, "            "))
+    nullable_columns = [index for index in columns if nullable[index]]
+    # the bitmap is a big-endian integer, the first nullable field is its lowest bit
+    null_bytes = (len(nullable_columns) + 7) // 8
+    for bit, index in enumerate(nullable_columns):
+        byte = f"buffer[at + {null_bytes - 1 - bit // 8}]"
+        lines.append(f"            p{index}[n] = ({byte} & {1 << (bit % 8)}) == 0")
+    if nullable_columns:
+        lines.append(f"            at += {null_bytes}")
+    for index in nullable_columns:
+        lines.append(f"            if p{index}[n]:")
+        lines.extend(read(index, "                ", checked=True))
+        # the value isn't on disk, this keeps the column free of garbage
+        lines.append("            else:")
+        lines.append(f"                v{index}[n] = 0")
+    lines.extend(
+        [
+            # records longer than the schema describes are from a different schema
+            "            if at != record_end:",
+            "                return -1, offset",
+            "            n += 1",
+            "        offset = record_end",
+            # a partial record header is left at the end of a torn write
+            "    if n < capacity and offset != end:",
+            "        return -1, offset",
+            "    return n, offset",
+        ]
+    )
+
+    namespace: typing.Dict[str, typing.Any] = {"numpy": numpy}
+    exec("\n".join(lines), namespace)  # nosec
+    return namespace["decode"]
+
+
+def build_block_decoder(schema: dict) -> typing.Optional[BlockDecoder]:
+    """
+    Get the block decoder for the schema, decoders are built once per distinct schema.
+    Returns None if the schema isn't all fixed-width, or it has nullable fields and
+    Numba isn't available.
+    """
+    if any(info["type"] not in FIXED_WIDTH_TYPES for info in schema.values()):
+        return None
+    if numba is None and any(info.get("nullable", True) for info in schema.values()):
+        return None  # pragma: no cover
+    key = tuple((info["type"], info.get("nullable", True)) for info in schema.values())
+    if key not in _DECODERS:
+        _DECODERS[key] = BlockDecoder(schema)
+    return _DECODERS[key]
@@ -8,24 +8,55 @@ Typical usage example:
     # it also supports dictionary style API too:
     disk["hamlet"] = "shakespeare"
 """
-import io
+import mmap
 import os.path
 import struct
 import typing
-from collections import namedtuple
+import weakref
 
+import pyarrow
+from hadro.block_decoder import build_block_decoder
 from hadro.config import WRITE_CONSISTENCY
 from hadro.config import ConsistencyMode
+from hadro.predicates import compile_batch_filter
+from hadro.predicates import compile_row_predicate
+from hadro.predicates import predicate_columns
+from hadro.record import DELETED_FLAG
+from hadro.record import RECORD_HEADER
+from hadro.record import SCHEMA_MISMATCH
+from hadro.record import Row
 from orso import logging
-from orso.row import Row
 
 logging.set_log_name("MESOS")
 logger = logging.get_logger()
 logger.setLevel(5)
 
-DELETED_FLAG: int = 1
+BATCH_SIZE: int = 64 * 1024
+TORN_RECORD: str = "Data file ends part-way through a record"
 
-RecordHeader = namedtuple("RecordHeader", ["flags", "size"])
+# the Arrow types for the schema types, other types are inferred by Arrow
+ARROW_TYPES: typing.Dict[str, pyarrow.DataType] = {
+    "BOOLEAN": pyarrow.bool_(),
+    "INTEGER": pyarrow.int64(),
+    "FLOAT": pyarrow.float64(),
+    "VARCHAR": pyarrow.string(),
+}
+
+
+def _write_pending(file: typing.BinaryIO, pending: bytearray) -> None:
+    # write out the appends waiting in the write buffer
+    with memoryview(pending) as view:
+        written = 0
+        while written < len(view):
+            written += os.write(file.fileno(), view[written:])
+    del pending[:]
+
+
+def _flush_unclosed(file: typing.BinaryIO, pending: bytearray) -> None:
+    # run when a collection which wasn't closed is garbage collected or the interpreter
+    # exits, so the appends in its write buffer aren't lost
+    if pending and not file.closed:
+        _write_pending(file, pending)
 
 
 # DiskStorage is a Log-Structured Hash Table as described in the BitCask paper. We
@@ -59,10 +90,21 @@ class HadroDB:
     """
     Implements the KV store on the disk
 
+    Appends are collected in a write buffer of up to 1Mb in the process, and written
+    to the data file when it fills, before a scan, and when the collection is closed.
+    Collections which aren't closed have their buffer written when they are garbage
+    collected or the interpreter exits, but appends still in the buffer are lost if
+    the process is killed or crashes. In ConsistencyMode.AGGRESSIVE (see hadro.config)
+    every append is written and synced to the disk before append returns.
+
     Args:
-        file_name (str): name of the file where all the data will be written. Just
-            passing the file name will save the data in the current directory. You may
-            pass the full file location too.
+        collection (str): name of the folder where all the data will be written. Just
+            passing the name will save the data in the current directory. You may
+            pass the full folder location too.
+        schema (dict): optional, the fields of the collection, a map of the field name
+            to its type and nullability.
+        varchar_mode (str): optional, how VARCHAR values are returned by scans, "str"
+            (the default), "bytes" or "dict", see hadro.record for details.
 
     Attributes:
         file_name (str): name of the file where all the data will be written. Just
@@ -77,7 +119,12 @@ class HadroDB:
             quickly from the disk
     """
 
-    def __init__(self, collection: typing.Union[str, None] = None):
+    def __init__(
+        self,
+        collection: typing.Union[str, None] = None,
+        schema: typing.Optional[dict] = None,
+        varchar_mode: str = "str",
+    ):
         logger.warning("HadroDB is experimental and not recommended for use.")
         self.collection: str = collection
         self.file_name: str = collection + "/00000000.data"
@@ -105,30 +152,106 @@ class HadroDB:
         #     default string mode)
         self.file: typing.BinaryIO = open(self.file_name, "a+b")
         self.fileno = self.file.fileno()
-
-        schema = {
-            "id": {"type": "SMALLINT", "nullable": False},
-            "planetId": {"type": "SMALLINT", "nullable": False},
-            "name": {"type": "VARCHAR", "nullable": False},
-            "gm": {"type": "FLOAT", "nullable": False},
-            "radius": {"type": "FLOAT", "nullable": False},
-            "density": {"type": "FLOAT", "nullable": True},
-            "magnitude": {"type": "FLOAT", "nullable": True},
-            "albedo": {"type": "FLOAT", "nullable": True},
-        }
-
-        self.rows = Row.create_class(schema)
+        self._map: typing.Optional[mmap.mmap] = None
+        self._write_buffer: bytearray = bytearray()
+        self._write_buffer_limit: int = 1 << 20  # 1Mb
+        # the finalizer holds the file and the buffer, not the collection
+        self._finalizer = weakref.finalize(self, _flush_unclosed, self.file, self._write_buffer)
+
+        if schema is None:
+            schema = {
+                "id": {"type": "SMALLINT", "nullable": False},
+                "planetId": {"type": "SMALLINT", "nullable": False},
+                "name": {"type": "VARCHAR", "nullable": False},
+                "gm": {"type": "FLOAT", "nullable": False},
+                "radius": {"type": "FLOAT", "nullable": False},
+                "density": {"type": "FLOAT", "nullable": True},
+                "magnitude": {"type": "FLOAT", "nullable": True},
+                "albedo": {"type": "FLOAT", "nullable": True},
+            }
+
+        self.rows = Row.create_class(schema, varchar_mode=varchar_mode)
+        self._required_fields = [
+            (index, field)
+            for index, (field, info) in enumerate(schema.items())
+            if not info.get("nullable", True)
+        ]
+        self._block_decoder = build_block_decoder(schema)
 
     def append(self, record) -> None:
+        # bulk loaders which know the shape of their records should call append_row or
+        # append_dict directly, they skip this check
         if isinstance(record, dict):
-            _record = record.values()
+            self.append_dict(record)
         else:
-            _record = record
-
-        record = self.rows(_record)
+            self.append_row(record)
+
+    def append_row(self, record) -> None:
+        """
+        Append a row of this collection, or a tuple of values in schema order.
+
+        Raises:
+            ValueError: if the values don't match the schema
+        """
+        rows = self.rows
+        # rows of this collection are used as they are, there's no need to rebuild them
+        if type(record) is not rows:
+            record = rows(record)
         # test it matches the schema
+        self._check_required(record)
+        try:
+            bytes_to_write = record.to_bytes()
+        except (struct.error, AttributeError, TypeError) as err:
+            raise ValueError(f"Record doesn't match the collection schema - {err}") from err
+        self._write(bytes_to_write)
 
-        bytes_to_write = record.to_bytes()
+        # update indices index
+        #
+
+        self.write_position += len(bytes_to_write)
+
+    def append_dict(self, record: dict) -> None:
+        """
+        Append a dictionary of values, keyed by field name, missing nullable fields are
+        null.
+
+        Raises:
+            ValueError: if a field which isn't nullable is missing or null
+        """
+        self.append_row(self.rows(self._dict_values(record)))
+
+    def append_batch(self, records: typing.Iterable) -> None:
+        """
+        Append many rows, tuples or lists of values in schema order, or dictionaries
+        (see append_dict), as one write.
+
+        The records are packed straight into a single buffer with the collection's
+        row codec, without creating a row for each of them. Nothing is written if any
+        of the records are rejected.
+
+        Raises:
+            ValueError: if a record isn't the shape of the schema
+        """
+        packer = self.rows._packer
+        pack_header = RECORD_HEADER.pack
+        width = len(self.rows._fields)
+        bytes_to_write = bytearray()
+        for record in records:
+            if isinstance(record, dict):
+                record = self._dict_values(record)
+            elif not isinstance(record, (tuple, list)) or len(record) != width:
+                # the msgpack codec would write these as they are
+                raise ValueError(f"Records must be dictionaries or sequences of {width} values")
+            else:
+                self._check_required(record)
+            try:
+                record_bytes = packer(record)
+            except (struct.error, AttributeError, TypeError) as err:
+                raise ValueError(f"Record doesn't match the collection schema - {err}") from err
+            bytes_to_write += pack_header(0, len(record_bytes))
+            bytes_to_write += record_bytes
+        if not bytes_to_write:
+            return
         self._write(bytes_to_write)
 
         # update indices index
@@ -136,52 +259,197 @@ class HadroDB:
 
         self.write_position += len(bytes_to_write)
 
+    def _dict_values(self, record: dict) -> list:
+        # read the values in schema order, the dict's order may not match it
+        values = [record.get(field) for field in self.rows._fields]
+        self._check_required(values)
+        return values
+
+    def _check_required(self, values: typing.Sequence) -> None:
+        # nulls in fields which aren't nullable would fail in the struct codec with
+        # an unhelpful error, and be written as they are by the msgpack codec
+        if None in values:
+            for index, field in self._required_fields:
+                if values[index] is None:
+                    raise ValueError(f"Field '{field}' isn't nullable but has no value")
+
     def scan(self, columns=None, predicates=None):
-        block_size: int = 8 * 1024 * 1024  # read 1Mb at a time
-        self.file.seek(0, 0)
+        for rows in self._scan_rows(predicates):
+            yield from rows
+
+    def scan_batches(
+        self, columns=None, predicates=None, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[pyarrow.RecordBatch]:
+        """
+        Read the collection as Arrow record batches of up to batch_size rows.
+
+        Rows are decoded a batch at a time, each batch is turned into one Arrow array
+        per column, so analytical readers work on contiguous columns rather than on
+        individual rows. Predicates are evaluated, and columns selected, a batch at a
+        time with Arrow compute kernels. INTEGER and FLOAT columns without nulls can be
+        handed to numpy without copying using `.to_numpy(zero_copy_only=True)`.
+
+        Batches without any rows which meet the predicates aren't returned, an empty
+        batch is returned if no rows are read, so readers always see the columns and
+        their types.
+
+        Args:
+            columns (list[str]): optional, the columns to read, defaults to all of them
+            predicates (list[tuple]): optional, (column, operator, value) conditions the
+                rows must all meet, see hadro.predicates
+            batch_size (int): optional, the most rows in each batch
+
+        Raises:
+            ValueError: if a column isn't in the collection, or batch_size is less than
+                one
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least one")
+        fields = self.rows._fields
+        if columns is None:
+            columns = fields
+        columns = list(columns)
+        for column in columns:
+            if column not in fields:
+                raise ValueError(f"Scan references unknown column '{column}'")
+        batch_filter = compile_batch_filter(fields, predicates)
+        # the predicates may need columns which aren't being returned
+        needed = list(dict.fromkeys([*columns, *predicate_columns(predicates)]))
+        indices = [fields.index(column) for column in needed]
+        types = [ARROW_TYPES.get(self.rows._schema[column]["type"]) for column in needed]
+
+        def to_batch(rows):
+            # transpose the rows into columns in one pass
+            values = list(zip(*rows)) or [()] * len(fields)
+            arrays = [
+                pyarrow.array(values[index], type=arrow_type)
+                for index, arrow_type in zip(indices, types)
+            ]
+            batch = pyarrow.RecordBatch.from_arrays(arrays, names=needed)
+            if batch_filter is not None:
+                batch = batch.filter(batch_filter(batch))
+            return batch.select(columns)
+
+        empty = True
+        if self._block_decoder is not None:
+            # each batch of records is decoded in one compiled pass as it is asked for
+            mapped = self._mapped()
+            block = b"" if mapped is None else mapped
+            for values, present in self._block_decoder.decode_batches(block, batch_size):
+                arrays = [
+                    pyarrow.array(
+                        values[index],
+                        type=arrow_type,
+                        mask=None if present[index] is None else ~present[index],
+                    )
+                    for index, arrow_type in zip(indices, types)
+                ]
+                batch = pyarrow.RecordBatch.from_arrays(arrays, names=needed)
+                if batch_filter is not None:
+                    batch = batch.filter(batch_filter(batch))
+                if batch.num_rows:
+                    empty = False
+                    yield batch.select(columns)
+        else:
+            for rows in self._scan_rows(batch_size=batch_size):
+                batch = to_batch(rows)
+                if batch.num_rows:
+                    empty = False
+                    yield batch
+        if empty:
+            yield to_batch([])
+
+    def scan_columns(self, columns=None, predicates=None) -> pyarrow.Table:
+        """
+        Read the collection into a columnar Arrow table, see scan_batches.
+
+        Args:
+            columns (list[str]): optional, the columns to read, defaults to all of them
+            predicates (list[tuple]): optional, (column, operator, value) conditions the
+                rows must all meet, see hadro.predicates
+        """
+        return pyarrow.Table.from_batches(list(self.scan_batches(columns, predicates)))
+
+    def _scan_rows(self, predicates=None, batch_size: int = BATCH_SIZE):
+        # Rows are decoded into lists of up to batch_size rows, so the generator only
+        # suspends and resumes once per batch rather than once per row.
+        # a reader per scan, so dictionary mode doesn't share values between scans
+        from_bytes = self.rows.reader()
+        # a precompiled struct reads the header faster than int.from_bytes on slices
+        read_header = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        # VARCHAR values read as bytes are compared as bytes
+        bytes_columns: typing.List[str] = []
+        if self.rows._varchar_mode == "bytes":
+            schema = self.rows._schema
+            bytes_columns = [field for field in schema if schema[field]["type"] == "VARCHAR"]
+        predicate = compile_row_predicate(self.rows._fields, predicates, bytes_columns)
 
         # TODO: read file header
 
-        buffer = io.BufferedReader(self.file, block_size)  # type: ignore
-
-        header_bytes = buffer.read(5)
-        flags, size = struct.unpack(">BI", header_bytes)
-        block_start = 5  # start of the current block
-
-        while size > 0:
-            if block_start + size > block_size:
-                # The current record spans multiple blocks, so read the rest of it in the next block
-                remaining_size = size - (block_size - block_start)
-                data_bytes = bytearray(
-                    buffer.read(block_size - block_start)
-                )  # read the remaining bytes in the current block
-                while remaining_size > 0:
-                    # Read the remaining bytes in subsequent blocks
-                    block_bytes = buffer.read(min(remaining_size, block_size))
-                    data_bytes += block_bytes
-                    remaining_size -= len(block_bytes)
-                    block_start = len(block_bytes)
-            else:
-                # The current record fits in the current block, so just read it
-                data_bytes = bytearray(buffer.read(size))
-                block_start += size
+        mapped = self._mapped()
+        if mapped is None:
+            return
+        file_size = len(mapped)
+
+        with memoryview(mapped) as view:
+            rows: list = []
+            offset = 0
+            while offset + header_size <= file_size:
+                flags, size = read_header(view, offset)
+                offset += header_size
+                if flags & DELETED_FLAG:
+                    # step over deleted records without touching their payload
+                    offset += size
+                    continue
+                if offset + size > file_size:
+                    raise ValueError(TORN_RECORD)
+                try:
+                    row = from_bytes(view[offset : offset + size])
+                except (struct.error, IndexError) as err:
+                    # the record is shorter than the schema
+                    raise ValueError(SCHEMA_MISMATCH) from err
+                offset += size
+                if predicate is None or predicate(row):
+                    rows.append(row)
+                    if len(rows) == batch_size:
+                        yield rows
+                        rows = []
+            if rows:
+                yield rows
+            if offset != file_size:
+                raise ValueError(TORN_RECORD)
+
+    def _mapped(self) -> typing.Optional[mmap.mmap]:
+        # The data file is memory mapped and records are decoded directly from the
+        # mapped pages, there are no read calls or copies into intermediate buffers,
+        # the OS pages the file in as we walk it.
+        if self._write_buffer:
+            self._flush()
+        file_size = os.fstat(self.fileno).st_size
+        if file_size == 0:
+            return None
+        if self._map is None or len(self._map) != file_size:
+            self._map = mmap.mmap(self.fileno, 0, access=mmap.ACCESS_READ)
+        return self._map
 
-            if flags & DELETED_FLAG == 0:
-                yield self.rows.from_bytes(data_bytes)
+    def _write(self, data: bytes) -> None:
+        # appends are collected in a write buffer and written with a single os.write
+        # when the buffer fills, small rows would otherwise cost a syscall each
+        self._write_buffer += data
 
-            # Read the size of the next record
-            header_bytes = buffer.read(5)
-            if len(header_bytes) == 0:
-                break
-            flags, size = struct.unpack(">BI", header_bytes)
-            block_start += 5  # add the size of the size field to the start of the next block
+        if WRITE_CONSISTENCY == ConsistencyMode.AGGRESSIVE:
+            # in aggressive mode every record is persisted before we move on
+            self._flush()
+        elif len(self._write_buffer) >= self._write_buffer_limit:
+            self._flush()
 
-    def _write(self, data: bytes) -> None:
+    def _flush(self) -> None:
         # saving stuff to a file reliably is hard!
         # if you would like to explore and learn more, then
         # start from here: https://danluu.com/file-consistency/
         # and read this too: https://lwn.net/Articles/457667/
-        os.write(self.fileno, data)
+        _write_pending(self.file, self._write_buffer)
 
         if WRITE_CONSISTENCY == ConsistencyMode.AGGRESSIVE:
             # calling fsync after every write is important, this assures that our writes
@@ -192,6 +460,11 @@ class HadroDB:
         # before we close the file, we need to safely write the contents in the buffers
         # to the disk. Check documentation of DiskStorage._write() to understand
         # following the operations
+        self._flush()
         self.file.flush()
         os.fsync(self.fileno)
+        # the map isn't closed explicitly, open scans may still hold views over it, it
+        # is unmapped when the last reference to it is released
+        self._map = None
+        self._finalizer.detach()
         self.file.close()
@@ -0,0 +1,107 @@
+# ---------------------------------------------------------------------------------
+# Predicates are given to scans as a list of (column, operator, value) tuples which
+# must all be true for a row to be returned, for example:
+#
+#   [("gm", ">", 1e20), ("name", "!=", "Moon")]
+#
+# Comparisons with nulls are false, as they are in SQL.
+#
+# Predicates are compiled once per scan: to a generated Python function when reading
+# rows, and to Arrow compute kernels when reading columns, where they are evaluated a
+# batch at a time.
+
+import typing
+
+import pyarrow
+import pyarrow.compute
+
+PYTHON_OPERATORS: typing.Dict[str, str] = {
+    "=": "==",
+    "==": "==",
+    "!=": "!=",
+    ">": ">",
+    ">=": ">=",
+    "<": "<",
+    "<=": "<=",
+}
+ARROW_OPERATORS: typing.Dict[str, typing.Callable] = {
+    "=": pyarrow.compute.equal,
+    "==": pyarrow.compute.equal,
+    "!=": pyarrow.compute.not_equal,
+    ">": pyarrow.compute.greater,
+    ">=": pyarrow.compute.greater_equal,
+    "<": pyarrow.compute.less,
+    "<=": pyarrow.compute.less_equal,
+}
+
+
+def _validate(fields: typing.Tuple[str, ...], predicates: list) -> None:
+    for column, operator, _ in predicates:
+        if column not in fields:
+            raise ValueError(f"Predicate references unknown column '{column}'")
+        if operator not in PYTHON_OPERATORS:
+            raise ValueError(f"Predicate has unsupported operator '{operator}'")
+
+
+def predicate_columns(predicates: typing.Optional[list]) -> typing.List[str]:
+    """The columns the predicates reference, in the order they are first referenced."""
+    return list(dict.fromkeys(column for column, _, _ in predicates or []))
+
+
+def compile_row_predicate(
+    fields: typing.Tuple[str, ...],
+    predicates: typing.Optional[list],
+    bytes_columns: typing.Container[str] = (),
+) -> typing.Optional[typing.Callable]:
+    """
+    Generate a function which tests a row against the predicates, with the position
+    of each column written out. Returns None if there are no predicates.
+
+    bytes_columns are the VARCHAR columns read as views over the UTF-8 bytes (see
+    hadro.record), their values are compared as bytes, which orders the same as the
+    strings do.
+    """
+    if not predicates:
+        return None
+    _validate(fields, predicates)
+
+    namespace: typing.Dict[str, typing.Any] = {}
+    clauses = []
+    for number, (column, operator, value) in enumerate(predicates):
+        index = fields.index(column)
+        cell = f"row[{index}]"
+        if column in bytes_columns:
+            # views can be tested for equality but not ordered
+            cell = f"bytes(row[{index}])"
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+        namespace[f"_v{number}"] = value
+        clauses.append(
+            f"(row[{index}] is not None and {cell} {PYTHON_OPERATORS[operator]} _v{number})"
+        )
+    exec("def predicate(row):\n    return " + " and ".join(clauses), namespace)  # nosec
+    return namespace["predicate"]
+
+
+def compile_batch_filter(
+    fields: typing.Tuple[str, ...], predicates: typing.Optional[list]
+) -> typing.Optional[typing.Callable]:
+    """
+    Build a function which evaluates the predicates over an Arrow table or record
+    batch, returning the boolean mask of matching rows. Returns None if there are no
+    predicates.
+    """
+    if not predicates:
+        return None
+    _validate(fields, predicates)
+
+    kernels = [(column, ARROW_OPERATORS[operator], value) for column, operator, value in predicates]
+
+    def batch_filter(batch):
+        mask = None
+        for column, kernel, value in kernels:
+            condition = kernel(batch.column(column), value)
+            mask = condition if mask is None else pyarrow.compute.and_(mask, condition)
+        return mask
+
+    return batch_filter
@@ -0,0 +1,317 @@
+# ---------------------------------------------------------------------------------
+# Our record when saved looks like this
+#
+#   ┌───────┬───────────┬────────────┐
+#   │ flags | row_size  │ row values │
+#   └───────┴───────────┴────────────┘
+#
+# flags currently has a single flag of deleted.
+#
+# Where every field in the schema has a supported type, the row values look like this
+#
+#   ┌──────────────┬─────────────┬──────────────────┐
+#   │ fixed values │ null bitmap │ remaining values │
+#   └──────────────┴─────────────┴──────────────────┘
+#
+# All numbers are big-endian:
+#   - 'fixed values' are the non-nullable BOOLEAN, INTEGER and FLOAT (1, 8 and 8
+#     bytes) values, in schema order, so they can be packed in a single call
+#   - 'null bitmap' is one bit per nullable field, rounded up to whole bytes, the
+#     lowest bit is the first nullable field and a bit is set when the value is null
+#   - 'remaining values' are the other fields in schema order; VARCHAR is a two byte
+#     length followed by the UTF-8 encoded string, so is at most 65535 bytes, nullable
+#     values are only written when they aren't null
+#
+# Schemas with other types fall back to writing the row values with msgpack.
+#
+# How VARCHAR values are read is chosen when the row class is created:
+#   - "str", the default, decodes each value to a str
+#   - "bytes" skips decoding and returns a view over the buffer the row was read from,
+#     when scanning this is the memory mapped data file so the view stays valid after
+#     the scan moves on
+#   - "dict" decodes each distinct value once and returns the same str for repeats,
+#     for low cardinality columns this avoids allocating a str per row. The values are
+#     shared between the rows read by one reader (see Row.reader), each scan has its
+#     own reader so the dictionaries only live as long as the scan
+#
+# Row object looks and acts like a Tuple where possible, but has additional features
+# such as as_dict() to render as a dictionary.
+
+import struct
+import typing
+
+from ormsgpack import packb
+from ormsgpack import unpackb
+
+FIXED_WIDTH_TYPES: typing.Dict[str, str] = {"BOOLEAN": "?", "INTEGER": "q", "FLOAT": "d"}
+VARIABLE_WIDTH_TYPES: typing.Set[str] = {"VARCHAR"}
+
+VARCHAR_MODES: typing.Set[str] = {"str", "bytes", "dict"}
+DICTIONARY_LIMIT: int = 64 * 1024
+
+# the record header, a byte of flags and the size of the record
+RECORD_HEADER = struct.Struct(">BI")
+DELETED_FLAG: int = 1
+
+_VARCHAR_LENGTH = struct.Struct(">H")
+VARCHAR_LIMIT: int = (1 << (8 * _VARCHAR_LENGTH.size)) - 1
+
+SCHEMA_MISMATCH: str = "Data file records don't match the collection schema"
+
+_CLASS_CACHE: typing.Dict[tuple, type] = {}
+
+
+def _build_codec(
+    schema: dict, varchar_mode: str = "str"
+) -> typing.Tuple[typing.Callable, typing.Callable]:
+    """
+    Walk the schema once and generate the functions used to write and read row values,
+    the structs are precompiled so the per-row work doesn't need to interpret the
+    schema or parse format strings.
+
+    Returns the packer and a function which creates an unpacker, each unpacker has its
+    own dictionaries in "dict" mode.
+    """
+    fixed_codes: typing.List[str] = []
+    fixed_index: typing.List[int] = []
+    null_index: typing.List[int] = []
+    tail: list = []
+    dictionaries: typing.List[int] = []
+
+    for index, info in enumerate(schema.values()):
+        field_type = info["type"]
+        nullable = info.get("nullable", True)
+        if field_type not in FIXED_WIDTH_TYPES and field_type not in VARIABLE_WIDTH_TYPES:
+            return _pack_msgpack, _new_msgpack_unpacker
+        if field_type in FIXED_WIDTH_TYPES and not nullable:
+            fixed_codes.append(FIXED_WIDTH_TYPES[field_type])
+            fixed_index.append(index)
+            continue
+        flag = -1
+        if nullable:
+            flag = len(null_index)
+            null_index.append(index)
+        codec = None
+        if field_type in FIXED_WIDTH_TYPES:
+            codec = struct.Struct(">" + FIXED_WIDTH_TYPES[field_type])
+        # (position in the row, bit in the null bitmap, struct - None for VARCHAR)
+        tail.append((index, flag, codec))
+
+    names = list(schema)
+    fixed = struct.Struct(">" + "".join(fixed_codes))
+    null_bytes = (len(null_index) + 7) // 8
+    namespace: typing.Dict[str, typing.Any] = {
+        "_fixed": fixed,
+        "_length": _VARCHAR_LENGTH,
+        "_BUFFERS": (bytes, bytearray, memoryview),
+    }
+    values = ", ".join(f"v{i}" for i in range(len(schema))) + ","
+
+    pack = ["def packer(row):", f"    {values} = row"]
+    pack.append(f"    out = bytearray(_fixed.pack({', '.join(f'v{i}' for i in fixed_index)}))")
+    if null_index:
+        bits = " | ".join(f"((v{i} is None) << {bit})" for bit, i in enumerate(null_index))
+        pack.append(f"    out += ({bits}).to_bytes({null_bytes}, 'big')")
+
+    unpack = ["def unpacker(data):"]
+    if fixed_index:
+        unpack.append(
+            f"    {', '.join(f'v{i}' for i in fixed_index)}, = _fixed.unpack_from(data, 0)"
+        )
+    if null_bytes == 1:
+        unpack.append(f"    nulls = data[{fixed.size}]")
+    elif null_bytes > 1:
+        end = fixed.size + null_bytes
+        unpack.append(f"    nulls = int.from_bytes(data[{fixed.size} : {end}], 'big')")
+    unpack.append(f"    offset = {fixed.size + null_bytes}")
+
+    for index, flag, codec in tail:
+        indent = "    "
+        if flag >= 0:
+            pack.append(f"    if v{index} is not None:")
+            unpack.append(f"    v{index} = None")
+            unpack.append(f"    if not nulls & {1 << flag}:")
+            indent = "        "
+        if codec is not None:
+            namespace[f"_s{index}"] = codec
+            pack.append(f"{indent}out += _s{index}.pack(v{index})")
+            unpack.append(f"{indent}v{index}, = _s{index}.unpack_from(data, offset)")
+            unpack.append(f"{indent}offset += {codec.size}")
+        else:
+            if varchar_mode == "str":
+                pack.append(f"{indent}e{index} = v{index}.encode('utf-8')")
+            else:
+                # values read back in the other modes may be bytes, nothing else is
+                # accepted, bytes() would turn an int into that many zero bytes
+                message = f"VARCHAR field '{names[index]}' must be str or bytes"
+                pack.append(f"{indent}if isinstance(v{index}, str):")
+                pack.append(f"{indent}    e{index} = v{index}.encode('utf-8')")
+                pack.append(f"{indent}elif isinstance(v{index}, _BUFFERS):")
+                pack.append(f"{indent}    e{index} = bytes(v{index})")
+                pack.append(f"{indent}else:")
+                pack.append(f"{indent}    raise TypeError({message!r})")
+            message = f"VARCHAR field '{names[index]}' is over {VARCHAR_LIMIT} bytes"
+            pack.append(f"{indent}l{index} = len(e{index})")
+            pack.append(f"{indent}if l{index} > {VARCHAR_LIMIT}:")
+            pack.append(f"{indent}    raise ValueError({message!r})")
+            pack.append(f"{indent}out += _length.pack(l{index})")
+            pack.append(f"{indent}out += e{index}")
+            unpack.append(f"{indent}l{index}, = _length.unpack_from(data, offset)")
+            unpack.append(f"{indent}offset += {_VARCHAR_LENGTH.size}")
+            if varchar_mode == "bytes":
+                unpack.append(f"{indent}v{index} = data[offset : offset + l{index}]")
+            elif varchar_mode == "dict":
+                dictionaries.append(index)
+                unpack.append(f"{indent}r{index} = bytes(data[offset : offset + l{index}])")
+                unpack.append(f"{indent}v{index} = _d{index}.get(r{index})")
+                unpack.append(f"{indent}if v{index} is None:")
+                unpack.append(f"{indent}    v{index} = r{index}.decode('utf-8')")
+                unpack.append(f"{indent}    if len(_d{index}) < {DICTIONARY_LIMIT}:")
+                unpack.append(f"{indent}        _d{index}[r{index}] = v{index}")
+            else:
+                unpack.append(f"{indent}v{index} = str(data[offset : offset + l{index}], 'utf-8')")
+            unpack.append(f"{indent}offset += l{index}")
+
+    pack.append("    return bytes(out)")
+    # a record from another schema can be read without running out of data
+    unpack.append("    if offset != len(data):")
+    unpack.append(f"        raise ValueError({SCHEMA_MISMATCH!r})")
+    unpack.append(f"    return ({values})")
+
+    # the unpacker is created in a closure which holds its dictionaries
+    new_unpacker = ["def new_unpacker():"]
+    new_unpacker.extend(f"    _d{index} = {{}}" for index in dictionaries)
+    new_unpacker.extend("    " + line for line in unpack)
+    new_unpacker.append("    return unpacker")
+
+    # the schema is interpreted here, once, the generated functions are straight-line
+    # code with the offsets and structs for each field baked in
+    exec("\n".join(pack + [""] + new_unpacker), namespace)  # nosec
+    return namespace["packer"], namespace["new_unpacker"]
+
+
+def _build_as_dict(fields: typing.Tuple[str, ...]) -> typing.Callable:
+    """
+    Generate as_dict for the fields, building the dict from a literal with the field
+    names and positions written out.
+    """
+    items = ", ".join(f"{field!r}: self[{index}]" for index, field in enumerate(fields))
+    namespace: typing.Dict[str, typing.Any] = {}
+    exec(f"def as_dict(self):\n    return {{{items}}}", namespace)  # nosec
+    return namespace["as_dict"]
+
+
+def _pack_msgpack(row) -> bytes:
+    return packb(tuple(row))
+
+
+def _unpack_msgpack(data) -> list:
+    return unpackb(data)
+
+
+def _new_msgpack_unpacker() -> typing.Callable:
+    return _unpack_msgpack
+
+
+class Row(tuple):
+    __slots__ = ()
+    _fields: typing.Tuple[str, ...] = ()
+    _schema: dict = {}
+    _varchar_mode: str = "str"
+    _packer: typing.Callable = staticmethod(_pack_msgpack)
+    _unpacker: typing.Callable = staticmethod(_unpack_msgpack)
+    _new_unpacker: typing.Callable = staticmethod(_new_msgpack_unpacker)
+
+    def __new__(cls, data):
+        return super().__new__(cls, data)
+
+    @property
+    def as_dict(self):
+        return {k: v for k, v in zip(self._fields, self)}
+
+    @property
+    def values(self):
+        return tuple(self)
+
+    def keys(self):
+        return self._fields
+
+    def __repr__(self):
+        return f"Row{super().__repr__()}"
+
+    def __str__(self):
+        return str(self.as_dict)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("can't set attribute")
+
+    def __delattr__(self, name):
+        raise AttributeError("can't delete attribute")
+
+    @classmethod
+    def from_bytes(cls, data) -> "Row":
+        return cls(cls._unpacker(data))
+
+    @classmethod
+    def reader(cls) -> typing.Callable:
+        """
+        Get a function which reads rows like from_bytes, for reading many rows. In
+        "dict" mode repeated values are shared between the rows one reader reads.
+        """
+        unpacker = cls._unpacker
+        if cls._varchar_mode == "dict":
+            unpacker = cls._new_unpacker()
+
+        def read(data) -> "Row":
+            return cls(unpacker(data))
+
+        return read
+
+    def to_bytes(self) -> bytes:
+        record_bytes = self._packer(self)
+        return RECORD_HEADER.pack(0, len(record_bytes)) + record_bytes
+
+    @classmethod
+    def create_class(cls, schema: dict, varchar_mode: str = "str") -> type:
+        if varchar_mode not in VARCHAR_MODES:
+            raise ValueError(f"Unknown VARCHAR mode '{varchar_mode}'")
+        if not schema:
+            raise ValueError("Schemas must have at least one field")
+
+        # row classes are reused for identical schemas, so collections sharing a
+        # schema share the generated code and their rows are the same type
+        key = (
+            tuple(
+                (name, info["type"], info.get("nullable", True)) for name, info in schema.items()
+            ),
+            varchar_mode,
+        )
+        row_class = _CLASS_CACHE.get(key)
+        if row_class is not None:
+            return row_class
+
+        packer, new_unpacker = _build_codec(schema, varchar_mode)
+        if varchar_mode == "dict":
+            # rows read on their own don't share dictionaries
+            def unpack_alone(data):
+                return new_unpacker()(data)
+
+            unpacker = unpack_alone
+        else:
+            # without dictionaries unpackers have no state, one is shared
+            unpacker = new_unpacker()
+        fields = tuple(schema)
+        row_class = type(
+            "RowClass",
+            (Row,),
+            {
+                "_fields": fields,
+                "_schema": schema,
+                "_varchar_mode": varchar_mode,
+                "_packer": staticmethod(packer),
+                "_unpacker": staticmethod(unpacker),
+                "_new_unpacker": staticmethod(new_unpacker),
+                "as_dict": property(_build_as_dict(fields)),
+            },
+        )
+        return _CLASS_CACHE.setdefault(key, row_class)
@@ -10,6 +10,7 @@ from hadro import HadroDB  # isort: skip
 
 
 TEST_COLLECTION = "test_123"
+SCHEMA = {"document": {"type": "VARCHAR", "nullable": False}}
 
 
 def create_doc(docs):
@@ -28,7 +29,7 @@ def test_interface():
     comparision_set_of_docs = {}
 
     # OPEN COLLECTION
-    hadro = HadroDB(TEST_COLLECTION)
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
 
     # SET DOCUMENT IN COLLECTION
     # subscript syntax
@@ -0,0 +1,168 @@
+import os
+import sys
+
+sys.path.insert(1, os.path.join(sys.path[0], ".."))
+
+from hadro.record import Row  # isort: skip
+
+SCHEMA = {
+    "id": {"type": "INTEGER", "nullable": False},
+    "planetId": {"type": "INTEGER", "nullable": False},
+    "name": {"type": "VARCHAR", "nullable": False},
+    "gm": {"type": "FLOAT", "nullable": False},
+    "radius": {"type": "FLOAT", "nullable": False},
+    "density": {"type": "FLOAT", "nullable": True},
+    "active": {"type": "BOOLEAN", "nullable": False},
+    "nickname": {"type": "VARCHAR", "nullable": True},
+}
+
+
+def test_round_trip():
+    rows = Row.create_class(SCHEMA)
+    record = rows((1, 3, "Moon", 4902.8, 1737.4, 3.344, True, "Luna"))
+
+    decoded = rows.from_bytes(record.to_bytes()[5:])
+
+    assert decoded == record
+    assert decoded.as_dict["name"] == "Moon"
+
+
+def test_round_trip_nulls():
+    rows = Row.create_class(SCHEMA)
+    record = rows((2, 4, "Phobos", 0.0007, 11.1, None, False, None))
+
+    decoded = rows.from_bytes(record.to_bytes()[5:])
+
+    assert decoded == record
+    assert decoded.as_dict["density"] is None
+
+
+def test_round_trip_many_nullable_fields():
+    # more than eight nullable fields need a second byte in the null bitmap
+    rows = Row.create_class({f"c{i}": {"type": "INTEGER", "nullable": True} for i in range(10)})
+    record = rows((None, 1, 2, 3, 4, 5, 6, 7, None, 9))
+
+    record_bytes = record.to_bytes()[5:]
+
+    assert len(record_bytes) == 2 + 8 * 8
+    assert rows.from_bytes(record_bytes) == record
+
+
+def test_record_longer_than_schema():
+    rows = Row.create_class(SCHEMA)
+    record_bytes = rows((1, 3, "Moon", 4902.8, 1737.4, 3.344, True, "Luna")).to_bytes()[5:]
+
+    try:
+        rows.from_bytes(record_bytes + b"\x00")
+    except ValueError:
+        pass
+    else:  # pragma: no cover
+        assert False, "records with bytes left over should be rejected"
+
+
+def test_varchar_bytes_mode():
+    rows = Row.create_class(SCHEMA, varchar_mode="bytes")
+    record = rows((1, 3, "Moon", 4902.8, 1737.4, 3.344, True, "Luna"))
+
+    decoded = rows.from_bytes(memoryview(record.to_bytes())[5:])
+
+    assert bytes(decoded[2]) == b"Moon"
+    assert bytes(decoded[7]) == b"Luna"
+    # values read as bytes can be written back
+    assert decoded.to_bytes() == record.to_bytes()
+    # but other values aren't taken as bytes
+    try:
+        rows((1, 3, 4, 4902.8, 1737.4, 3.344, True, None)).to_bytes()
+    except TypeError:
+        pass
+    else:  # pragma: no cover
+        assert False, "VARCHAR values which aren't str or bytes should be rejected"
+
+
+def test_varchar_dict_mode():
+    rows = Row.create_class(SCHEMA, varchar_mode="dict")
+    record_bytes = rows((1, 3, "Moon", 4902.8, 1737.4, 3.344, True, None)).to_bytes()[5:]
+
+    read = rows.reader()
+    first = read(record_bytes)
+    second = read(record_bytes)
+
+    assert first[2] == "Moon"
+    assert first[2] is second[2]
+    assert first[7] is None
+    # values aren't shared between readers
+    assert rows.reader()(record_bytes)[2] is not first[2]
+    assert rows.from_bytes(record_bytes) == first
+
+
+def test_varchar_limit():
+    rows = Row.create_class(SCHEMA)
+
+    assert rows.from_bytes(rows((1, 3, "M" * 65535, 1.0, 1.0, None, True, None)).to_bytes()[5:])
+    try:
+        rows((1, 3, "M" * 65536, 1.0, 1.0, None, True, None)).to_bytes()
+    except ValueError as err:
+        assert "'name'" in str(err)
+    else:  # pragma: no cover
+        assert False, "VARCHAR values over the limit should be rejected"
+
+
+def test_empty_schema():
+    try:
+        Row.create_class({})
+    except ValueError:
+        pass
+    else:  # pragma: no cover
+        assert False, "schemas without fields should be rejected"
+
+
+def test_unknown_varchar_mode():
+    try:
+        Row.create_class(SCHEMA, varchar_mode="latin-1")
+    except ValueError:
+        pass
+    else:  # pragma: no cover
+        assert False, "unknown VARCHAR modes should be rejected"
+
+
+def test_row_classes_are_reused():
+    rows = Row.create_class(SCHEMA)
+
+    assert Row.create_class(dict(SCHEMA)) is rows
+    assert Row.create_class(SCHEMA, varchar_mode="bytes") is not rows
+    assert isinstance(Row.create_class(SCHEMA)((1, 3, "Moon", 1.0, 1.0, None, True, None)), rows)
+
+
+def test_record_header():
+    rows = Row.create_class(SCHEMA)
+    record = rows((1, 3, "Moon", 4902.8, 1737.4, 3.344, True, "Luna"))
+
+    record_bytes = record.to_bytes()
+
+    assert record_bytes[0] == 0
+    assert int.from_bytes(record_bytes[1:5], "big") == len(record_bytes) - 5
+
+
+def test_unsupported_type_falls_back():
+    rows = Row.create_class({"id": {"type": "SMALLINT"}, "when": {"type": "TIMESTAMP"}})
+    record = rows((1, "2023-03-01"))
+
+    decoded = rows.from_bytes(record.to_bytes()[5:])
+
+    assert decoded == record
+
+
+if __name__ == "__main__":  # pragma: no cover
+    test_round_trip()
+    test_round_trip_nulls()
+    test_round_trip_many_nullable_fields()
+    test_record_longer_than_schema()
+    test_varchar_bytes_mode()
+    test_varchar_dict_mode()
+    test_varchar_limit()
+    test_empty_schema()
+    test_unknown_varchar_mode()
+    test_row_classes_are_reused()
+    test_record_header()
+    test_unsupported_type_falls_back()
+    print("okay")
@@ -0,0 +1,529 @@
+import gc
+import os
+import shutil
+import sys
+
+sys.path.insert(1, os.path.join(sys.path[0], ".."))
+
+from hadro import HadroDB  # isort: skip
+
+TEST_COLLECTION = "test_scan"
+
+SCHEMA = {
+    "id": {"type": "INTEGER", "nullable": False},
+    "planetId": {"type": "INTEGER", "nullable": False},
+    "name": {"type": "VARCHAR", "nullable": False},
+    "gm": {"type": "FLOAT", "nullable": False},
+    "radius": {"type": "FLOAT", "nullable": False},
+    "density": {"type": "FLOAT", "nullable": True},
+    "magnitude": {"type": "FLOAT", "nullable": True},
+    "albedo": {"type": "FLOAT", "nullable": True},
+}
+
+MOONS = [
+    (1, 3, "Moon", 4902.801, 1737.5, 3.344, -12.74, 0.12),
+    (2, 4, "Phobos", 0.000711, 11.1, 1.872, 11.4, 0.071),
+    (3, 4, "Deimos", 0.000099, 6.2, 1.471, 12.45, 0.068),
+    (4, 5, "Io", 5959.916, 1821.6, 3.528, 5.02, 0.63),
+    (5, 5, "Europa", 3202.739, 1560.8, None, None, None),
+]
+
+# without the VARCHAR, so every field is fixed-width, some are nullable
+FIXED_SCHEMA = {name: info for name, info in SCHEMA.items() if info["type"] != "VARCHAR"}
+FIXED_MOONS = [moon[:2] + moon[3:] for moon in MOONS]
+# none of the fields nullable, so every record is the same size, Europa has nulls
+FIXED_SIZE_SCHEMA = {name: dict(info, nullable=False) for name, info in FIXED_SCHEMA.items()}
+FIXED_SIZE_MOONS = FIXED_MOONS[:4]
+
+
+def _reset():
+    if os.path.exists(TEST_COLLECTION):  # pragma: no cover
+        shutil.rmtree(TEST_COLLECTION, ignore_errors=True)
+
+
+def test_scan_round_trip():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    for moon in MOONS:
+        hadro.append(moon)
+
+    assert list(hadro.scan()) == MOONS
+
+    hadro.close()
+    _reset()
+
+
+def test_append_dicts_and_rows():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    # dict keys in a different order to the schema, and missing a nullable field
+    hadro.append({"name": "Moon", "id": 1, "planetId": 3, "gm": 4902.801, "radius": 1737.5})
+    hadro.append(hadro.rows(MOONS[1]))
+
+    assert list(hadro.scan()) == [
+        (1, 3, "Moon", 4902.801, 1737.5, None, None, None),
+        MOONS[1],
+    ]
+
+    hadro.close()
+    _reset()
+
+
+def test_append_dict_missing_field():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+
+    moon = dict(zip(SCHEMA, MOONS[0]))
+    missing = {field: value for field, value in moon.items() if field != "radius"}
+    no_gm = MOONS[0][:3] + (None,) + MOONS[0][4:]
+    for record, field in ((missing, "radius"), (dict(moon, gm=None), "gm"), (no_gm, "gm")):
+        try:
+            hadro.append(record)
+        except ValueError as err:
+            assert f"'{field}'" in str(err)
+        else:  # pragma: no cover
+            assert False, "fields which aren't nullable should be required"
+    assert list(hadro.scan()) == []
+
+    hadro.close()
+    _reset()
+
+
+def test_append_batch():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    hadro.append_row(MOONS[0])
+    hadro.append_batch(MOONS[1:4])
+    hadro.append_batch([])
+    hadro.append_dict(dict(zip(SCHEMA, MOONS[4])))
+
+    assert list(hadro.scan()) == MOONS
+    assert hadro.write_position == os.path.getsize(hadro.file_name)
+
+    hadro.close()
+    _reset()
+
+
+def test_append_batch_rejects_records():
+    for schema in (SCHEMA, None):
+        _reset()
+        hadro = HadroDB(TEST_COLLECTION, schema=schema)
+        # dictionaries are read in schema order
+        hadro.append_batch([dict(reversed(list(zip(hadro.rows._fields, MOONS[0]))))])
+        assert list(hadro.scan()) == MOONS[:1]
+
+        records = [
+            MOONS[1][:-1],
+            "Phobos",
+            {"name": "Phobos"},
+            (2, 4, "Phobos", None, 11.1, None, None, None),
+        ]
+        if schema is not None:
+            # only the struct codec checks the types of the values
+            records.append((2, 4, "Phobos", "0.000711", 11.1, None, None, None))
+        for record in records:
+            try:
+                hadro.append_batch([MOONS[2], record])
+            except ValueError:
+                pass
+            else:  # pragma: no cover
+                assert False, "records which don't match the schema should be rejected"
+        assert list(hadro.scan()) == MOONS[:1]
+
+        hadro.close()
+    _reset()
+
+
+def test_scan_sees_later_appends():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    hadro.append(MOONS[0])
+    assert list(hadro.scan()) == MOONS[:1]
+
+    for moon in MOONS[1:]:
+        hadro.append(moon)
+    assert list(hadro.scan()) == MOONS
+
+    # closing with a scan part-way through
+    scanner = hadro.scan()
+    next(scanner)
+    hadro.close()
+    _reset()
+
+
+def test_appends_persisted_on_close():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    for moon in MOONS:
+        hadro.append(moon)
+    hadro.close()
+
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    assert list(hadro.scan()) == MOONS
+
+    hadro.close()
+    _reset()
+
+
+def test_appends_persisted_without_close():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    for moon in MOONS:
+        hadro.append(moon)
+    file_name = hadro.file_name
+    assert os.path.getsize(file_name) == 0
+    # the write buffer is written when the collection is garbage collected
+    del hadro
+    gc.collect()
+
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    assert list(hadro.scan()) == MOONS
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_empty_collection():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+
+    assert list(hadro.scan()) == []
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_varchar_bytes():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA, varchar_mode="bytes")
+    for moon in MOONS:
+        hadro.append(moon)
+
+    names = [row[2] for row in hadro.scan()]
+    hadro.close()
+
+    # the views are over the mapped file and outlive the scan
+    assert [bytes(name).decode() for name in names] == [moon[2] for moon in MOONS]
+    _reset()
+
+
+def test_scan_columns():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    for moon in MOONS:
+        hadro.append(moon)
+
+    table = hadro.scan_columns()
+    assert table.num_rows == len(MOONS)
+    assert table.column_names == list(SCHEMA)
+    assert table.column("name").to_pylist() == [moon[2] for moon in MOONS]
+    assert table.column("density").null_count == 1
+
+    table = hadro.scan_columns(columns=["gm", "id"])
+    assert table.column_names == ["gm", "id"]
+    assert list(table.column("id").to_numpy()) == [moon[0] for moon in MOONS]
+
+    try:
+        hadro.scan_columns(columns=["id", "mass"])
+    except ValueError as err:
+        assert "'mass'" in str(err)
+    else:  # pragma: no cover
+        assert False, "unknown columns should be rejected"
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_columns_empty_collection():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+
+    table = hadro.scan_columns(columns=["id", "name"])
+    assert table.num_rows == 0
+    assert table.column_names == ["id", "name"]
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_columns_fixed_width():
+    fixed_schema = dict(FIXED_SCHEMA, habitable={"type": "BOOLEAN", "nullable": True})
+    moons = [moon + (i % 2 == 0 if i else None,) for i, moon in enumerate(FIXED_MOONS)]
+
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=fixed_schema)
+    for moon in moons:
+        hadro.append(moon)
+
+    table = hadro.scan_columns()
+    assert table.to_pylist() == [dict(zip(fixed_schema, moon)) for moon in moons]
+
+    # the same result without the compiled decoder
+    hadro._block_decoder = None
+    assert hadro.scan_columns().equals(table)
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_skips_deleted():
+    for schema, records in (
+        (SCHEMA, MOONS),
+        (FIXED_SCHEMA, FIXED_MOONS),
+        # read through the structured numpy view
+        (FIXED_SIZE_SCHEMA, FIXED_SIZE_MOONS),
+    ):
+        _reset()
+        hadro = HadroDB(TEST_COLLECTION, schema=schema)
+        for i, record in enumerate(records):
+            record_bytes = hadro.rows(record).to_bytes()
+            if i % 2:
+                # set the deleted flag
+                record_bytes = b"\x01" + record_bytes[1:]
+            hadro._write(record_bytes)
+
+        assert list(hadro.scan()) == records[::2]
+        assert hadro.scan_columns(columns=["id"]).column("id").to_pylist() == [
+            record[0] for record in records[::2]
+        ]
+        if schema is FIXED_SIZE_SCHEMA:
+            assert hadro._block_decoder._record_dtype is not None
+            assert hadro.scan_columns().to_pylist() == [
+                dict(zip(schema, record)) for record in records[::2]
+            ]
+
+        hadro.close()
+    _reset()
+
+
+def test_scan_batches():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    for moon in MOONS:
+        hadro.append(moon)
+
+    batches = list(hadro.scan_batches(columns=["id", "name"], batch_size=2))
+    assert [batch.num_rows for batch in batches] == [2, 2, 1]
+    assert all(batch.schema.names == ["id", "name"] for batch in batches)
+    assert [i for batch in batches for i in batch.column("id").to_pylist()] == [1, 2, 3, 4, 5]
+
+    hadro.close()
+
+    # the block decoder decodes a batch of records at a time too
+    for schema in (FIXED_SCHEMA, FIXED_SIZE_SCHEMA):
+        _reset()
+        hadro = HadroDB(TEST_COLLECTION, schema=schema)
+        for moon in FIXED_SIZE_MOONS * 2:
+            hadro.append(moon)
+
+        batches = hadro.scan_batches(columns=["id"], batch_size=3)
+        assert next(batches).column("id").to_pylist() == [1, 2, 3]
+        assert [batch.num_rows for batch in batches] == [3, 2]
+
+        batches = hadro.scan_batches(columns=["id"], predicates=[("id", "=", 4)], batch_size=3)
+        assert [batch.column("id").to_pylist() for batch in batches] == [[4], [4]]
+
+        try:
+            next(hadro.scan_batches(batch_size=0))
+        except ValueError:
+            pass
+        else:  # pragma: no cover
+            assert False, "batches must hold at least one row"
+
+        # batches without any matching rows are skipped with or without the decoder
+        hadro._block_decoder = None
+        batches = hadro.scan_batches(columns=["id"], predicates=[("id", "=", 4)], batch_size=3)
+        assert [batch.column("id").to_pylist() for batch in batches] == [[4], [4]]
+
+        hadro.close()
+    _reset()
+
+
+def test_scan_predicates():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA)
+    for moon in MOONS:
+        hadro.append(moon)
+
+    assert list(hadro.scan(predicates=[("planetId", "=", 4)])) == MOONS[1:3]
+    # comparisons with nulls are false
+    assert list(hadro.scan(predicates=[("density", "<", 3.5), ("gm", ">", 1)])) == MOONS[:1]
+
+    table = hadro.scan_columns(columns=["name"], predicates=[("density", "<", 3.5)])
+    assert table.column_names == ["name"]
+    assert table.column("name").to_pylist() == ["Moon", "Phobos", "Deimos"]
+
+    try:
+        list(hadro.scan(predicates=[("gm", "~", 1)]))
+    except ValueError:
+        pass
+    else:  # pragma: no cover
+        assert False, "unsupported operators should be rejected"
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_predicates_varchar_bytes():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=SCHEMA, varchar_mode="bytes")
+    for moon in MOONS:
+        hadro.append(moon)
+
+    assert [row[0] for row in hadro.scan(predicates=[("name", "=", "Moon")])] == [1]
+    assert [row[0] for row in hadro.scan(predicates=[("name", "<", "Io")])] == [3, 5]
+    assert [row[0] for row in hadro.scan(predicates=[("name", "!=", b"Io")])] == [1, 2, 3, 5]
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_columns_predicates_fixed_width():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=FIXED_SCHEMA)
+    for moon in FIXED_MOONS:
+        hadro.append(moon)
+
+    predicates = [("planetId", ">=", 4), ("albedo", "<", 0.5)]
+    table = hadro.scan_columns(columns=["id"], predicates=predicates)
+    assert table.column("id").to_pylist() == [2, 3]
+
+    hadro._block_decoder = None
+    assert hadro.scan_columns(columns=["id"], predicates=predicates).equals(table)
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_columns_fixed_size_records():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=FIXED_SIZE_SCHEMA)
+    for moon in FIXED_SIZE_MOONS:
+        hadro.append(moon)
+
+    table = hadro.scan_columns()
+    assert table.to_pylist() == [dict(zip(FIXED_SIZE_SCHEMA, moon)) for moon in FIXED_SIZE_MOONS]
+    # the numeric columns can be read by numpy without copying
+    gm = table.column("gm").chunk(0).to_numpy(zero_copy_only=True)
+    assert gm[0] == FIXED_SIZE_MOONS[0][2]
+
+    hadro._block_decoder = None
+    assert hadro.scan_columns().equals(table)
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_columns_many_nullable_fields():
+    schema = {f"c{i}": {"type": "FLOAT", "nullable": True} for i in range(10)}
+    records = [tuple(None if (i + j) % 3 == 0 else i * j / 2 for j in range(10)) for i in range(7)]
+
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=schema)
+    for record in records:
+        hadro.append(record)
+
+    table = hadro.scan_columns()
+    assert table.to_pylist() == [dict(zip(schema, record)) for record in records]
+
+    hadro._block_decoder = None
+    assert hadro.scan_columns().equals(table)
+
+    hadro.close()
+    _reset()
+
+
+def test_scan_columns_schema_mismatch():
+    other_schemas = (
+        {"z": {"type": "INTEGER", "nullable": True}},
+        {"z": {"type": "INTEGER", "nullable": False}},
+        # records shorter than the schema
+        {f"z{i}": {"type": "INTEGER", "nullable": False} for i in range(10)},
+    )
+
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION, schema=FIXED_SCHEMA)
+    for moon in FIXED_MOONS:
+        hadro.append(moon)
+    hadro.close()
+
+    for schema in other_schemas:
+        hadro = HadroDB(TEST_COLLECTION, schema=schema)
+        # with and without the block decoder, and record by record
+        for scanner in (hadro.scan_columns, lambda: list(hadro.scan())):
+            try:
+                scanner()
+            except ValueError:
+                pass
+            else:  # pragma: no cover
+                assert False, "records written with another schema should be rejected"
+        hadro.close()
+    _reset()
+
+
+def test_scan_truncated_file():
+    def tear_record(file_name):
+        os.truncate(file_name, os.path.getsize(file_name) - 4)
+
+    def tear_header(file_name):
+        with open(file_name, "ab") as data_file:
+            data_file.write(b"\x00\x00")
+
+    for schema in (FIXED_SCHEMA, FIXED_SIZE_SCHEMA):
+        for tear in (tear_record, tear_header):
+            _reset()
+            hadro = HadroDB(TEST_COLLECTION, schema=schema)
+            for moon in FIXED_SIZE_MOONS:
+                hadro.append(moon)
+            hadro.close()
+            tear(hadro.file_name)
+
+            hadro = HadroDB(TEST_COLLECTION, schema=schema)
+            for scanner in (hadro.scan_columns, lambda: list(hadro.scan())):
+                try:
+                    scanner()
+                except ValueError:
+                    pass
+                else:  # pragma: no cover
+                    assert False, "torn records should be rejected"
+            hadro.close()
+    _reset()
+
+
+def test_scan_msgpack_schema():
+    _reset()
+    hadro = HadroDB(TEST_COLLECTION)
+    for moon in MOONS:
+        hadro.append(moon)
+
+    assert list(hadro.scan()) == MOONS
+
+    hadro.close()
+    _reset()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    test_scan_round_trip()
+    test_append_dicts_and_rows()
+    test_append_dict_missing_field()
+    test_append_batch()
+    test_append_batch_rejects_records()
+    test_scan_sees_later_appends()
+    test_appends_persisted_on_close()
+    test_appends_persisted_without_close()
+    test_scan_empty_collection()
+    test_scan_varchar_bytes()
+    test_scan_columns()
+    test_scan_columns_empty_collection()
+    test_scan_columns_fixed_width()
+    test_scan_skips_deleted()
+    test_scan_batches()
+    test_scan_predicates()
+    test_scan_predicates_varchar_bytes()
+    test_scan_columns_predicates_fixed_width()
+    test_scan_columns_fixed_size_records()
+    test_scan_columns_many_nullable_fields()
+    test_scan_columns_schema_mismatch()
+    test_scan_truncated_file()
+    test_scan_msgpack_schema()
+    print("okay")